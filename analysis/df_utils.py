@@ -1,124 +1,168 @@
+from typing import TypeVar
+
 import polars as pl
 
+FrameT = TypeVar("FrameT", pl.DataFrame, pl.LazyFrame)
+
+# Number of values packed into each bitmask column
+BITMASK_WORD_SIZE = 64
+
+# Complete rentalInfo structure set on every pricingInfos entry
+COMPLETE_RENTAL_INFO = {
+    "period": None,
+    "warranties": [],
+    "monthlyRentalTotalPrice": None,
+}
+RENTAL_INFO_DTYPE = pl.Struct(
+    {
+        "period": pl.Null,
+        "warranties": pl.List(pl.Null),
+        "monthlyRentalTotalPrice": pl.Null,
+    }
+)
+
 
 def get_list_column_max_len(df: pl.DataFrame, list_column: str):
     return df.select(pl.col(list_column).list.len().max()).item()
 
 
-def one_hot_encode_list_column(df: pl.DataFrame, list_column: str) -> pl.DataFrame:
+def one_hot_encode_list_column(df: FrameT, list_column: str) -> FrameT:
     """
-    One-hot encode a column containing lists in a Polars DataFrame.
+    One-hot encode a column containing lists in a Polars DataFrame or LazyFrame.
 
     Args:
-        df: Input Polars DataFrame
+        df: Input Polars DataFrame or LazyFrame
         list_column: Name of the column containing lists
 
     Returns:
-        DataFrame with one-hot encoded columns
+        DataFrame or LazyFrame, matching the input, with one-hot encoded columns
     """
     # Get unique values across all lists
-    unique_values = df.select(pl.col(list_column).explode()).to_series().unique().sort()
+    unique_values = _get_unique_list_values(df, list_column)
 
     # Creat one-hot encoded columns
     encoded_columns = [
         pl.col(list_column).list.contains(value).alias(f"{list_column}_{value}")
         for value in unique_values
-        if value is not None
     ]
 
     return df.with_columns(encoded_columns).drop(list_column)
 
 
-def _normalize_rental_info(df: pl.DataFrame) -> pl.DataFrame:
-    """
-    Add missing rentalInfo struct to pricingInfos and ensure consistent schema.
-    Returns DataFrame with normalized pricingInfos structure.
+def bitmask_encode_list_column(
+    df: FrameT, list_column: str
+) -> tuple[FrameT, list[str]]:
     """
-    # Get all field names from the listing struct
-    listing_fields = [f.name for f in df.schema["listing"].fields]  # type: ignore
-
-    # Check a sample row for rentalInfo structure
-    sample_pricing = df.select(pl.col("listing").struct.field("pricingInfos")).row(0)[
-        0
-    ][0]
-
-    # Create the complete rentalInfo structure
-    complete_rental_info = {
-        "period": None,
-        "warranties": [],
-        "monthlyRentalTotalPrice": None,
-    }
+    Encode a column containing lists as bitmasks, one bit per unique value.
+
+    Bits are packed into UInt64 columns named "{list_column}_bitmask_{i}", the
+    i-th one holding the values at positions 64 * i to 64 * i + 63.
 
-    if "rentalInfo" not in sample_pricing:
-        rental_info_update = complete_rental_info
-    else:
-        # If rentalInfo exists but is missing fields or is None, add them
-        existing_rental_info = sample_pricing.get("rentalInfo", {}) or {}
-        rental_info_update = {**complete_rental_info, **existing_rental_info}
-
-    # Create a new column with updated pricingInfos
-    df = df.with_columns(
-        [
-            pl.col("listing")
-            .struct.field("pricingInfos")
-            .map_elements(
-                lambda x: [
-                    {**pricing_info, "rentalInfo": rental_info_update}
-                    for pricing_info in x
-                ]
+    Args:
+        df: Input Polars DataFrame or LazyFrame
+        list_column: Name of the column containing lists
+
+    Returns:
+        DataFrame or LazyFrame, matching the input, with the bitmask columns in
+        place of the list column, and the encoded values in bit order
+    """
+    values = _get_unique_list_values(df, list_column)
+
+    bitmask_columns = []
+    for word_start in range(0, len(values), BITMASK_WORD_SIZE):
+        word_values = values[word_start : word_start + BITMASK_WORD_SIZE]
+        bits = pl.Series([1 << bit for bit in range(len(word_values))], dtype=pl.UInt64)
+        # The bits of distinct values never overlap, so their sum is their union
+        bitmask_columns.append(
+            pl.col(list_column)
+            .list.eval(
+                pl.element()
+                .unique()
+                .replace_strict(word_values, bits, default=0, return_dtype=pl.UInt64)
             )
-            .alias("new_pricing_infos")
-        ]
-    )
+            .list.sum()
+            .alias(f"{list_column}_bitmask_{word_start // BITMASK_WORD_SIZE}")
+        )
 
-    # Create expressions for all fields in the listing struct
-    struct_fields = [
-        pl.col("listing").struct.field(f).alias(f)
-        for f in listing_fields
-        if f != "pricingInfos"
-    ]
+    return df.with_columns(bitmask_columns).drop(list_column), values
 
-    # Add the new pricingInfos
-    struct_fields.append(pl.col("new_pricing_infos").alias("pricingInfos"))
 
-    # Create the new listing struct
-    df = df.with_columns([pl.struct(struct_fields).alias("listing")])
+def bitmask_contains(list_column: str, values: list[str], value: str) -> pl.Expr:
+    """
+    Build an expression testing whether a value is set in bitmask columns created
+    by bitmask_encode_list_column.
 
-    # Drop the temporary column
-    df = df.drop("new_pricing_infos")
+    Args:
+        list_column: Name of the list column that was encoded
+        values: Encoded values, as returned by bitmask_encode_list_column
+        value: Value to test for
+
+    Returns:
+        Boolean expression, True where the value is present
+    """
+    word, bit = divmod(values.index(value), BITMASK_WORD_SIZE)
+    bitmask = pl.col(f"{list_column}_bitmask_{word}")
+    return (bitmask & pl.lit(1 << bit, dtype=pl.UInt64)) != 0
+
+
+def _get_unique_list_values(df: pl.DataFrame | pl.LazyFrame, list_column: str) -> list:
+    """
+    Get the sorted non-null values found across all lists of a column.
+    The encoded column names depend on them, so this is collected even for a
+    LazyFrame.
+    """
+    return (
+        df.lazy()
+        .select(pl.col(list_column).explode().drop_nulls().unique().sort())
+        .collect()
+        .to_series()
+        .to_list()
+    )
+
+
+def _normalize_rental_info(df: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Add missing rentalInfo struct to pricingInfos and ensure consistent schema.
+    Returns LazyFrame with normalized pricingInfos structure.
+    """
+    # Get all field names from the listing struct
+    listing_fields = [f.name for f in df.collect_schema()["listing"].fields]  # type: ignore
+
+    # Set the complete rentalInfo on every pricingInfos entry without leaving Polars
+    pricing_infos = (
+        pl.col("listing")
+        .struct.field("pricingInfos")
+        .list.eval(
+            pl.element().struct.with_fields(
+                rentalInfo=pl.lit(COMPLETE_RENTAL_INFO, dtype=RENTAL_INFO_DTYPE)
+            )
+        )
+    )
 
     # Normalize capacityLimit to be List(Int64)
-    df = df.with_columns(
-        [
-            pl.col("listing")
-            .struct.field("capacityLimit")
-            .cast(pl.List(pl.Int64))
-            .alias("new_capacity_limit")
-        ]
+    capacity_limit = (
+        pl.col("listing").struct.field("capacityLimit").cast(pl.List(pl.Int64))
     )
 
-    # Update the listing struct again for capacityLimit
+    # Rebuild the listing struct in a single pass, moving capacityLimit to the end
     struct_fields = [
-        pl.col("listing").struct.field(f).alias(f)
+        (
+            pricing_infos if f == "pricingInfos" else pl.col("listing").struct.field(f)
+        ).alias(f)
         for f in listing_fields
         if f != "capacityLimit"
     ]
-    struct_fields.append(pl.col("new_capacity_limit").alias("capacityLimit"))
-
-    df = df.with_columns([pl.struct(struct_fields).alias("listing")])
-
-    # Drop the temporary column
-    df = df.drop("new_capacity_limit")
+    struct_fields.append(capacity_limit.alias("capacityLimit"))
 
-    return df
+    return df.with_columns([pl.struct(struct_fields).alias("listing")])
 
 
 def normalize_schemas(dfs: list[pl.DataFrame]) -> list[pl.DataFrame]:
     """
     Normalize schemas across multiple DataFrames to enable concatenation.
     """
-    # Normalize each DataFrame
-    normalized_dfs = [_normalize_rental_info(df) for df in dfs]
+    # Normalize each DataFrame lazily and materialize them all at once
+    normalized_dfs = pl.collect_all([_normalize_rental_info(df.lazy()) for df in dfs])
 
     # Verify schemas match
     base_schema = normalized_dfs[0].schema
@@ -1,61 +1,36 @@
-from xml.etree import ElementTree
-from typing import NamedTuple
+import math
+import re
 import sys
+import warnings
+from typing import NamedTuple
 
+import numba
+import numpy as np
 import polars as pl
+import shapely
+from lxml import etree
+from shapely.strtree import STRtree
 
 # Constants for floating-point precision handling
-EPSILON = 0.00001
-INFINITY = sys.float_info.max
 TINY = sys.float_info.min
 
 
-class Point(NamedTuple):
-    """A 2D point representation.
-
-    Attributes:
-        x: The x-coordinate (longitude in geographic context)
-        y: The y-coordinate (latitude in geographic context)
-    """
-
-    x: float
-    y: float
-
-
-class Edge(NamedTuple):
-    """A line segment between two points.
-
-    Attributes:
-        start: The starting point of the edge
-        end: The ending point of the edge
-    """
-
-    start: Point
-    end: Point
-
-
 class Polygon(NamedTuple):
-    """A polygon represented by its edges.
-
-    Attributes:
-        edges: List of edges forming the polygon
-    """
+    """A polygon represented by its edges, stored as one array per coordinate.
 
-    edges: list[Edge]
-
-
-class PolygonWithBBox(NamedTuple):
-    """A polygon with its precomputed bounding box.
+    Edge i goes from (edges_sx[i], edges_sy[i]) to (edges_ex[i], edges_ey[i]).
 
     Attributes:
-        polygon: The original polygon
-        min_p: Point representing the minimum coordinates of the bounding box
-        max_p: Point representing the maximum coordinates of the bounding box
+        edges_sx: x-coordinates of the starting point of each edge
+        edges_sy: y-coordinates of the starting point of each edge
+        edges_ex: x-coordinates of the ending point of each edge
+        edges_ey: y-coordinates of the ending point of each edge
     """
 
-    polygon: Polygon
-    min_p: Point
-    max_p: Point
+    edges_sx: np.ndarray
+    edges_sy: np.ndarray
+    edges_ex: np.ndarray
+    edges_ey: np.ndarray
 
 
 def extract_polygons_from_folder(file_path: str, folder_name: str) -> list[Polygon]:
@@ -68,33 +43,50 @@ def extract_polygons_from_folder(file_path: str, folder_name: str) -> list[Polyg
     Returns:
         A list of Polygon objects extracted from the specified folder.
     """
-    tree = ElementTree.parse(file_path)
-    root = tree.getroot()
-    namespace = root.tag.split("}")[0] + "}"
+    polygons = []
+    folder_found = False
+    # One entry per currently open folder, innermost last, telling whether that
+    # folder is the requested one or lies inside it. Placemarks are streamed and
+    # discarded as soon as they are parsed, so this is tracked while parsing
+    # instead of being looked up on the (pruned) tree.
+    in_target_folder: list[bool] = []
+
+    context = etree.iterparse(
+        file_path,
+        events=("start", "end"),
+        tag=("{*}Folder", "{*}name", "{*}Placemark"),
+    )
+    for event, elem in context:
+        namespace = elem.tag.split("}")[0] + "}"
+        local_name = elem.tag[len(namespace) :]
 
-    target_folder = _find_folder_by_name(root, folder_name, namespace)
-    if target_folder is None:
+        if local_name == "Folder":
+            if event == "start":
+                in_target_folder.append(bool(in_target_folder) and in_target_folder[-1])
+                continue
+            if in_target_folder.pop() and not (
+                in_target_folder and in_target_folder[-1]
+            ):
+                # Only the first folder with the requested name is used
+                break
+            _discard_element(elem)
+        elif local_name == "name":
+            if event == "end" and in_target_folder and elem.text == folder_name:
+                parent = elem.getparent()
+                if parent is not None and parent.tag == f"{namespace}Folder":
+                    in_target_folder[-1] = True
+                    folder_found = True
+        elif event == "end":
+            if in_target_folder and in_target_folder[-1]:
+                polygon = _extract_polygon(elem, namespace)
+                if polygon is not None:
+                    polygons.append(polygon)
+            _discard_element(elem)
+
+    if not folder_found:
         print(f"Folder '{folder_name}' not found in the KML file")
         return []
 
-    polygons = []
-    for placemark in target_folder.findall(f".//{namespace}Placemark"):
-        polygon = placemark.find(f".//{namespace}Polygon")
-        if polygon is not None:
-            outer_boundary = polygon.find(f".//{namespace}outerBoundaryIs")
-            if outer_boundary is not None:
-                coordinates = outer_boundary.find(f".//{namespace}coordinates")
-                coord_text = coordinates.text if coordinates is not None else None
-
-                points = _parse_coordinates(coord_text)
-                if points:
-                    edges = [
-                        Edge(points[i], points[(i + 1) % len(points)])
-                        for i in range(len(points))
-                    ]
-                    polygon = Polygon(edges)
-                    polygons.append(polygon)
-
     return polygons
 
 
@@ -109,194 +101,235 @@ def mark_points_in_polygons(df: pl.DataFrame, polygons: list[Polygon]) -> pl.Dat
         DataFrame with an additional 'flooded' boolean column indicating if each point
         falls within any polygon.
     """
-    processed_polygons = _preprocess_polygons(polygons)
-
-    return df.with_columns(
-        [
-            pl.struct(["lat", "lon", "approximateLat", "approximateLon"])
-            .map_elements(
-                lambda x: _check_point_in_any_polygon(
-                    x["lat"],
-                    x["lon"],
-                    x["approximateLat"],
-                    x["approximateLon"],
-                    processed_polygons,
-                )
-            )
-            .alias("flooded")
-        ]
+    bbox_index = _build_bbox_index(_preprocess_polygons(polygons))
+
+    # Exact coordinates fall back to the approximate ones; points with neither
+    # become NaN, which never matches any bounding box
+    coords = df.select(
+        pl.col("lon").fill_null(pl.col("approximateLon")).cast(pl.Float64),
+        pl.col("lat").fill_null(pl.col("approximateLat")).cast(pl.Float64),
     )
+    xs = coords["lon"].to_numpy()
+    ys = coords["lat"].to_numpy()
+
+    # Candidate (point, polygon) pairs whose bounding boxes intersect, grouped by
+    # polygon
+    point_idx, polygon_idx = bbox_index.query(shapely.points(xs, ys))
+    order = np.argsort(polygon_idx, kind="stable")
+    point_idx, polygon_idx = point_idx[order], polygon_idx[order]
+    polygon_ids, group_starts = np.unique(polygon_idx, return_index=True)
+
+    flooded = np.zeros(len(df), dtype=bool)
+    for polygon_id, candidates in zip(
+        polygon_ids, np.split(point_idx, group_starts[1:])
+    ):
+        candidates = candidates[~flooded[candidates]]
+        if candidates.size > 0:
+            flooded[candidates] = _are_points_inside_polygon(
+                xs[candidates], ys[candidates], polygons[polygon_id]
+            )
 
+    return df.with_columns(pl.Series("flooded", flooded))
 
-def _check_point_in_any_polygon(
-    lat: float | None,
-    lon: float | None,
-    approx_lat: float | None,
-    approx_lon: float | None,
-    processed_polygons: list[PolygonWithBBox],
-) -> bool:
-    """Checks if a point falls within any of the processed polygons.
+
+def _extract_polygon(placemark: etree._Element, namespace: str) -> Polygon | None:
+    """Builds a Polygon from the outer boundary of a KML Placemark.
 
     Args:
-        lat: The latitude coordinate.
-        lon: The longitude coordinate.
-        approx_lat: Approximate latitude if exact is not available.
-        approx_lon: Approximate longitude if exact is not available.
-        processed_polygons: List of preprocessed polygons with bounding boxes.
+        placemark: The Placemark element to read coordinates from.
+        namespace: KML namespace string.
 
     Returns:
-        True if the point falls within any polygon, False otherwise.
+        The Polygon described by the placemark, or None if it has no polygon
+        coordinates.
     """
-    final_lat = approx_lat if lat is None else lat
-    final_lon = approx_lon if lon is None else lon
+    polygon = placemark.find(f".//{namespace}Polygon")
+    if polygon is None:
+        return None
 
-    if final_lat is None or final_lon is None:
-        return False
+    outer_boundary = polygon.find(f".//{namespace}outerBoundaryIs")
+    if outer_boundary is None:
+        return None
 
-    point = Point(final_lon, final_lat)
+    coordinates = outer_boundary.find(f".//{namespace}coordinates")
+    coord_text = coordinates.text if coordinates is not None else None
 
-    for p in processed_polygons:
-        if _is_point_in_bbox(point, p.min_p, p.max_p):
-            if _is_point_inside_polygon(point, p.polygon):
-                return True
-    return False
+    coords = _parse_coordinates(coord_text)
+    if len(coords) == 0:
+        return None
 
+    # Each vertex starts one edge and the next vertex (wrapping around) ends it
+    sx, sy = coords[:, 0], coords[:, 1]
+    return Polygon(sx, sy, np.roll(sx, -1), np.roll(sy, -1))
 
-def _find_folder_by_name(
-    root: ElementTree.Element, folder_name: str, namespace: str
-) -> ElementTree.Element | None:
-    """Recursively searches for a folder with the specified name in the KML structure.
 
-    Args:
-        root: Current XML element to search from.
-        folder_name: Name of the folder to find.
-        namespace: KML namespace string.
+def _discard_element(elem: etree._Element) -> None:
+    """Frees an already processed element and its preceding siblings.
 
-    Returns:
-        The folder element if found, None otherwise.
-    """
-    for folder in root.findall(f".//{namespace}Folder"):
-        name_elem = folder.find(f"./{namespace}name")
-        if name_elem is not None and name_elem.text == folder_name:
-            return folder
+    Keeps memory usage flat while streaming through large KML files.
 
-        subfolder_result = _find_folder_by_name(folder, folder_name, namespace)
-        if subfolder_result is not None:
-            return subfolder_result
+    Args:
+        elem: The element that has been fully processed.
+    """
+    elem.clear()
+    parent = elem.getparent()
+    if parent is None:
+        return
+    while elem.getprevious() is not None:
+        del parent[0]
 
-    return None
 
+def _parse_coordinates(coord_text: str | None) -> np.ndarray:
+    """Parses a KML coordinate string into an array of coordinate pairs.
 
-def _parse_coordinates(coord_text: str | None) -> list[Point]:
-    """Parses a KML coordinate string into a list of Points.
+    Well-formed strings whose tuples all have the same number of values are parsed
+    in one go with numpy; anything else goes through a tolerant per-tuple parse
+    that skips invalid tuples.
 
     Args:
-        coord_text: String containing comma-separated coordinate pairs.
+        coord_text: String containing whitespace-separated "lon,lat[,alt]" tuples.
 
     Returns:
-        List of Point objects representing the parsed coordinates.
+        Array of shape (n, 2) holding the longitude and latitude of each tuple.
     """
-    if not coord_text:
-        return []
-
-    coord_list = []
-    for coord in coord_text.strip().split():
-        if coord.strip():
+    if not coord_text or not coord_text.strip():
+        return np.empty((0, 2))
+
+    coord_text = coord_text.strip()
+    values_per_coord = coord_text.split(maxsplit=1)[0].count(",") + 1
+    if values_per_coord >= 2 and _has_uniform_tuples(coord_text, values_per_coord):
+        # Depending on the numpy version, an unparsable value either raises or
+        # stops parsing early with a warning, so the size is checked as well
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
             try:
-                parts = coord.split(",")
-                if len(parts) >= 2:
-                    lon = float(parts[0])
-                    lat = float(parts[1])
-                    coord_list.append(Point(lon, lat))
-            except (ValueError, IndexError):
-                continue
+                values = np.fromstring(
+                    coord_text.replace(",", " "), dtype=np.float64, sep=" "
+                )
+            except ValueError:
+                values = None
+        expected_size = len(coord_text.split()) * values_per_coord
+        if values is not None and values.size == expected_size:
+            return values.reshape(-1, values_per_coord)[:, :2]
 
-    return coord_list
+    return _parse_coordinates_per_tuple(coord_text)
 
 
-def _ray_intersects_segment(point: Point, edge: Edge) -> bool:
-    """Determines if a horizontal ray cast from a point intersects with a line segment.
+def _has_uniform_tuples(coord_text: str, values_per_coord: int) -> bool:
+    """Checks that every tuple in a coordinate string has the same number of values.
 
     Args:
-        point: The point from which to cast the ray.
-        edge: The edge to test for intersection.
+        coord_text: Stripped string of whitespace-separated coordinate tuples.
+        values_per_coord: Number of comma-separated values expected per tuple.
 
     Returns:
-        True if the ray intersects the edge, False otherwise.
+        True if all tuples hold exactly values_per_coord non-empty values.
     """
-    start, end = edge
-
-    if start.y > end.y:
-        start, end = end, start
+    value = r"[^,\s]+"
+    coord = value + f"(?:,{value}){{{values_per_coord - 1}}}"
+    return re.fullmatch(f"{coord}(?:\\s+{coord})*", coord_text) is not None
 
-    if point.y == start.y or point.y == end.y:
-        point = Point(point.x, point.y + EPSILON)
 
-    if (point.y > end.y or point.y < start.y) or (point.x > max(start.x, end.x)):
-        return False
+def _parse_coordinates_per_tuple(coord_text: str) -> np.ndarray:
+    """Parses a KML coordinate string one tuple at a time, skipping invalid ones.
 
-    if point.x < min(start.x, end.x):
-        return True
-
-    if abs(start.x - end.x) > TINY:
-        slope_edge = (end.y - start.y) / float(end.x - start.x)
-    else:
-        slope_edge = INFINITY
+    Args:
+        coord_text: String containing whitespace-separated "lon,lat[,alt]" tuples.
 
-    if abs(start.x - point.x) > TINY:
-        slope_point = (point.y - start.y) / float(point.x - start.x)
-    else:
-        slope_point = INFINITY
+    Returns:
+        Array of shape (n, 2) holding the longitude and latitude of each valid tuple.
+    """
+    coord_list = []
+    for coord in coord_text.split():
+        try:
+            parts = coord.split(",")
+            if len(parts) >= 2:
+                coord_list.append((float(parts[0]), float(parts[1])))
+        except ValueError:
+            continue
 
-    return slope_point >= slope_edge
+    return np.array(coord_list, dtype=np.float64).reshape(-1, 2)
 
 
-def _is_point_inside_polygon(point: Point, polygon: Polygon) -> bool:
-    """Determines if a point lies inside a polygon using the ray casting algorithm.
+def _are_points_inside_polygon(
+    xs: np.ndarray, ys: np.ndarray, polygon: Polygon
+) -> np.ndarray:
+    """Determines which points lie inside a polygon using the ray casting algorithm.
 
     Args:
-        point: The point to test.
+        xs: The x-coordinates of the points to test.
+        ys: The y-coordinates of the points to test.
         polygon: The polygon to test against.
 
     Returns:
-        True if the point is inside the polygon, False otherwise.
+        Boolean array that is True for the points inside the polygon.
     """
-    intersection_count = sum(
-        _ray_intersects_segment(point, edge) for edge in polygon.edges
-    )
-    return intersection_count % 2 == 1
+    return _are_points_inside_edges(xs, ys, *polygon)
 
 
-def _get_bounding_box(polygon: Polygon) -> tuple[Point, Point]:
-    """Gets min/max points defining the bounding box of a polygon.
+@numba.njit(parallel=True, cache=True)
+def _are_points_inside_edges(
+    xs: np.ndarray,
+    ys: np.ndarray,
+    sx: np.ndarray,
+    sy: np.ndarray,
+    ex: np.ndarray,
+    ey: np.ndarray,
+) -> np.ndarray:
+    """Runs the ray casting test for every point against the given polygon edges.
+
+    Points are tested in parallel, each one walking over all edges.
 
     Args:
-        polygon: The polygon to compute the bounding box for.
+        xs: The x-coordinates of the points to test.
+        ys: The y-coordinates of the points to test.
+        sx: x-coordinates of the starting point of each edge.
+        sy: y-coordinates of the starting point of each edge.
+        ex: x-coordinates of the ending point of each edge.
+        ey: y-coordinates of the ending point of each edge.
 
     Returns:
-        A tuple of Points representing the minimum and maximum coordinates of the
-        bounding box.
+        Boolean array that is True for the points inside the polygon.
     """
-    xs = [edge.start.x for edge in polygon.edges] + [polygon.edges[-1].end.x]
-    ys = [edge.start.y for edge in polygon.edges] + [polygon.edges[-1].end.y]
-    return Point(min(xs), min(ys)), Point(max(xs), max(ys))
+    inside = np.zeros(xs.shape[0], dtype=np.bool_)
+    for i in numba.prange(xs.shape[0]):
+        point_inside = False
+        for j in range(sx.shape[0]):
+            point_inside ^= _ray_intersects_segment(
+                xs[i], ys[i], sx[j], sy[j], ex[j], ey[j]
+            )
+        inside[i] = point_inside
+    return inside
 
 
-def _is_point_in_bbox(point: Point, min_p: Point, max_p: Point) -> bool:
-    """Checks if point lies within bounding box.
+@numba.njit(cache=True)
+def _ray_intersects_segment(
+    px: float, py: float, sx: float, sy: float, ex: float, ey: float
+) -> bool:
+    """Determines if a horizontal ray cast from a point intersects with a line segment.
+
+    The segment is crossed when it straddles the point's y-coordinate and meets the
+    ray at or to the right of the point. Both conditions are always evaluated, so the
+    test compiles without branches.
 
     Args:
-        point: The point to test.
-        min_p: The minimum point of the bounding box.
-        max_p: The maximum point of the bounding box.
+        px: The x-coordinate of the point from which to cast the ray.
+        py: The y-coordinate of the point from which to cast the ray.
+        sx: The x-coordinate of the starting point of the segment.
+        sy: The y-coordinate of the starting point of the segment.
+        ex: The x-coordinate of the ending point of the segment.
+        ey: The y-coordinate of the ending point of the segment.
 
     Returns:
-        True if the point lies within the bounding box, False otherwise.
+        True if the ray intersects the segment, False otherwise.
     """
-    return min_p.x <= point.x <= max_p.x and min_p.y <= point.y <= max_p.y
+    straddles = (sy > py) != (ey > py)
+    # Horizontal segments never straddle, TINY only keeps their division defined
+    dy = ey - sy + math.copysign(TINY, ey - sy)
+    return straddles & (px <= (ex - sx) * (py - sy) / dy + sx)
 
 
-def _preprocess_polygons(polygons: list[Polygon]) -> list[PolygonWithBBox]:
+def _preprocess_polygons(polygons: list[Polygon]) -> np.ndarray:
     """Precomputes bounding boxes for all polygons for efficient point-in-polygon
     testing.
 
@@ -304,11 +337,23 @@ def _preprocess_polygons(polygons: list[Polygon]) -> list[PolygonWithBBox]:
         polygons: List of polygons to preprocess.
 
     Returns:
-        List of PolygonWithBBox objects containing the original polygons and their
-        bounding boxes.
+        Array of shape (4, len(polygons)) whose rows hold the minimum x, minimum y,
+        maximum x and maximum y of each polygon.
+    """
+    bboxes = np.empty((4, len(polygons)))
+    for i, polygon in enumerate(polygons):
+        xs, ys = polygon.edges_sx, polygon.edges_sy
+        bboxes[:, i] = xs.min(), ys.min(), xs.max(), ys.max()
+    return bboxes
+
+
+def _build_bbox_index(bboxes: np.ndarray) -> STRtree:
+    """Builds a spatial index over the bounding boxes of the polygons.
+
+    Args:
+        bboxes: Bounding boxes as returned by _preprocess_polygons.
+
+    Returns:
+        STRtree whose item indices match the polygon positions in bboxes.
     """
-    processed = []
-    for polygon in polygons:
-        min_p, max_p = _get_bounding_box(polygon)
-        processed.append(PolygonWithBBox(polygon, min_p, max_p))
-    return processed
+    return STRtree(shapely.box(*bboxes))
@@ -1,13 +1,15 @@
+import asyncio
 import logging
-import json
 import sys
-import time
 import uuid
 from contextlib import ExitStack
 from dataclasses import dataclass
 from functools import cached_property
+from typing import BinaryIO
 from urllib.parse import urlencode
 
+import orjson
+from aiolimiter import AsyncLimiter
 from curl_cffi import requests
 from tenacity import (
     retry,
@@ -16,9 +18,7 @@ from tenacity import (
     retry_if_result,
 )
 
-from zap_imoveis.account_fields import ACCOUNT_FIELDS
-from zap_imoveis.listing_fields import LISTING_FIELDS
-from zap_imoveis.query_builder import build_query_fields, build_search_query
+from zap_imoveis.query_builder import INCLUDE_FIELDS
 from zap_imoveis.search_params import (
     NeighborhoodSearchParams,
     get_address_search_params,
@@ -35,12 +35,16 @@ FIREFOX_AGENT = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:133.0) Gecko/20100101 Firefox/133.0"
 )
 
+# Throttling of the requests to the API
+MAX_CONCURRENT_REQUESTS = 8
+MAX_REQUESTS_PER_SECOND = 2
+MAX_PAGES = 500
+
 
 @dataclass
 class APIParams:
     """Container for API request parameters."""
 
-    device_id: str
     page: int
 
 
@@ -87,55 +91,66 @@ class ZapImoveisDataRetriever:
     # API configuration
     api_base_url = "https://glue-api.zapimoveis.com.br/v2/listings"
 
-    query_structure = build_search_query(
-        listing_fields=LISTING_FIELDS, account_fields=ACCOUNT_FIELDS
-    )
-    include_fields = f"{build_query_fields(query_structure)})"
+    include_fields = f"{INCLUDE_FIELDS})"
 
     @cached_property
-    def session(self) -> requests.Session:
+    def session(self) -> requests.AsyncSession:
         """Create and configure a curl_cffi session."""
-        return requests.Session()
+        return requests.AsyncSession()
+
+    @cached_property
+    def rate_limiter(self) -> AsyncLimiter:
+        """Limiter shared by every request of this retriever, retries included."""
+        return AsyncLimiter(1, 1 / MAX_REQUESTS_PER_SECOND)
+
+    @cached_property
+    def static_query(self) -> str:
+        """Encoded query parameters shared by every request of this retriever."""
+        return urlencode(
+            {
+                "user": self.device_id,
+                "portal": "ZAP",
+                "categoryPage": "RESULT",
+                "business": "SALE",
+                "listingType": "USED",
+                "size": self.items_per_page,
+                "topoFixoSize": "0",
+                "superPremiumSize": "0",
+                "developmentsSize": "4",
+                "viewport": "null",
+                "images": "webp",
+                "__zt": "mtc:deduplication2023",
+                "includeFields": self.include_fields,
+            }
+        )
 
     def _build_url(
         self, api_params: APIParams, neighorhood_params: NeighborhoodSearchParams
     ) -> str:
         """Build API URL with query parameters."""
 
-        search_params = {
-            "user": api_params.device_id,
-            "portal": "ZAP",
-            "categoryPage": "RESULT",
-            "business": "SALE",
-            "listingType": "USED",
-            "size": self.items_per_page,
-            "topoFixoSize": "0",
-            "superPremiumSize": "0",
-            "developmentsSize": "4",
+        page_params = {
             "from": str((api_params.page - 1) * self.items_per_page),
             "page": str(api_params.page),
-            "viewport": "null",
-            "images": "webp",
-            "__zt": "mtc:deduplication2023",
-        }
-        address_search_params = get_address_search_params(neighorhood_params)
-        params = {
-            **search_params,
-            **address_search_params,
-            "viewport": "null",
-            "includeFields": self.include_fields,
+            **get_address_search_params(neighorhood_params),
         }
-        return f"{self.api_base_url}?{urlencode(params)}"
+        return f"{self.api_base_url}?{self.static_query}&{urlencode(page_params)}"
 
-    def _get_headers(self, device_id: str) -> dict[str, str]:
-        """Get headers for the API request."""
+    @cached_property
+    def device_id(self) -> str:
+        """Device id reported to the API by every request of this retriever."""
+        return str(uuid.uuid4())
+
+    @cached_property
+    def headers(self) -> dict[str, str]:
+        """Headers for the API requests."""
         return {
             "User-Agent": FIREFOX_AGENT,
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
             "Accept-Language": "en-US,pt-BR;q=0.8,pt;q=0.5,en;q=0.3",
             "Accept-Encoding": "gzip, deflate, br, zstd",
             "X-Domain": ".zapimoveis.com.br",
-            "X-DeviceId": device_id,
+            "X-DeviceId": self.device_id,
         }
 
     @retry(
@@ -144,16 +159,99 @@ class ZapImoveisDataRetriever:
         retry=retry_if_result(is_retriable_status),
         before_sleep=log_retry,
     )
-    def get_listings(self, neighborhood: NeighborhoodSearchParams, page: int):
+    async def get_listings(self, neighborhood: NeighborhoodSearchParams, page: int):
         """Get listings from the zapimoveis API."""
-        device_id = str(uuid.uuid4())
-        api_params = APIParams(device_id=device_id, page=page)
+        api_params = APIParams(page=page)
         url = self._build_url(api_params, neighborhood)
-        headers = self._get_headers(device_id)
-        response = self.session.get(url, headers=headers)
+        async with self.rate_limiter:
+            response = await self.session.get(url, headers=self.headers)
         return response
 
 
+async def write_listings(
+    queue: asyncio.Queue[tuple[int, list[dict]] | None], listings_file: BinaryIO
+):
+    """Write pages of listings from the queue to a file until None is received."""
+    ids: set[int] = set()
+    while (item := await queue.get()) is not None:
+        page, listings = item
+        # Serialize the whole page and write it with a single call
+        page_buffer = bytearray()
+        for listing in listings:
+            # Listing ids are numeric strings, which hash faster as ints
+            id_ = int(listing["listing"]["id"])
+            if id_ in ids:
+                # Results shift between pages, so a listing may show up again
+                logger.warning(f"Skipping repeated listing {id_} at page {page}")
+                continue
+            ids.add(id_)
+            page_buffer += orjson.dumps(listing)
+            page_buffer += b"\n"
+        listings_file.write(page_buffer)
+
+
+async def collect_neighborhood(
+    retriever: ZapImoveisDataRetriever,
+    neighborhood: NeighborhoodSearchParams,
+    listings_file: BinaryIO,
+):
+    """Fetch all pages of a neighborhood concurrently and write their listings."""
+    queue: asyncio.Queue[tuple[int, list[dict]] | None] = asyncio.Queue()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    exhausted_at: int | None = None
+
+    async def collect_page(page: int):
+        nonlocal exhausted_at
+        async with semaphore:
+            # Pages past the end of the search need not be requested
+            if exhausted_at is not None and page > exhausted_at:
+                return
+            response = await retriever.get_listings(neighborhood, page=page)
+        search_results = response.json()
+        if "search" not in search_results:
+            if exhausted_at is None or page < exhausted_at:
+                exhausted_at = page
+                print(
+                    f"Search in neighborhood {neighborhood.name} "
+                    f"exhausted at page {page}. Response: {search_results}"
+                )
+            return
+        await queue.put((page, search_results["search"]["result"]["listings"]))
+
+    # A failing writer cancels the page fetches through the outer group, while a
+    # failing page cancels the other pages but lets the writer drain the queue
+    async with asyncio.TaskGroup() as tasks:
+        writer = tasks.create_task(write_listings(queue, listings_file))
+        try:
+            async with asyncio.TaskGroup() as pages:
+                for i in range(1, MAX_PAGES + 1):
+                    pages.create_task(collect_page(i))
+        finally:
+            await queue.put(None)
+            # Waiting rather than awaiting leaves a writer error to the outer group
+            await asyncio.wait([writer])
+
+    if exhausted_at is None:
+        print(
+            f"Search in neighborhood {neighborhood.name} finished at page {MAX_PAGES}."
+        )
+
+
+async def collect_neighborhoods(
+    retriever: ZapImoveisDataRetriever,
+    neighborhoods: list[NeighborhoodSearchParams],
+    files: dict[str, BinaryIO],
+):
+    """Collect the neighborhoods one after another into their files."""
+    try:
+        for neighborhood in neighborhoods:
+            await collect_neighborhood(
+                retriever, neighborhood, files[neighborhood.name]
+            )
+    finally:
+        await retriever.session.close()
+
+
 if __name__ == "__main__":
     retriever = ZapImoveisDataRetriever()
     neighborhoods = [menino_deus, cidade_baixa, centro_historico, sarandi]
@@ -161,30 +259,5 @@ if __name__ == "__main__":
         files = {}
         for neighborhood in neighborhoods:
             file_name = f"{neighborhood.name}.json"
-            files[neighborhood.name] = stack.enter_context(open(file_name, "a"))
-        for neighborhood in neighborhoods:
-            ids = set()
-            exhausted = False
-            for i in range(1, 501):
-                response = retriever.get_listings(neighborhood, page=i)
-                time.sleep(2)
-                search_results = response.json()
-                if "search" not in search_results:
-                    print(
-                        f"Search in neighborhood {neighborhood.name} "
-                        f"exhausted at page {i}. Response: {search_results}"
-                    )
-                    exhausted = True
-                    break
-                listings = search_results["search"]["result"]["listings"]
-                listings_file = files[neighborhood.name]
-                for listing in listings:
-                    if id_ := listing["listing"]["id"] in ids:
-                        raise ValueError(f"{id_} is repeated!")
-                    json.dump(listing, listings_file)
-                    listings_file.write("\n")
-            if not exhausted:
-                print(
-                    f"Search in neighborhood {neighborhood.name} "
-                    f"finished at page {i}."
-                )
+            files[neighborhood.name] = stack.enter_context(open(file_name, "ab"))
+        asyncio.run(collect_neighborhoods(retriever, neighborhoods, files))
@@ -41,15 +41,27 @@ def build_search_query(listing_fields=None, account_fields=None):
 
 def build_query_fields(fields_dict):
     """Build the final query string from the structure"""
-    if isinstance(fields_dict, dict):
-        parts = []
-        for key, value in fields_dict.items():
+    if not isinstance(fields_dict, dict):
+        return ",".join(fields_dict)
+
+    tokens = []
+    # Iterators over the items of the dicts being walked, innermost last
+    stack = [iter(fields_dict.items())]
+    while stack:
+        for key, value in stack[-1]:
+            if tokens and tokens[-1] != "(":
+                tokens.append(",")
+            tokens.append(key)
             if isinstance(value, dict):
-                nested_fields = build_query_fields(value)
-                parts.append(f"{key}({nested_fields})")
-            elif isinstance(value, list):
-                parts.append(f"{key}")
-            else:
-                parts.append(key)
-        return ",".join(parts)
-    return ",".join(fields_dict)
+                tokens.append("(")
+                stack.append(iter(value.items()))
+                break
+        else:
+            stack.pop()
+            if stack:
+                tokens.append(")")
+    return "".join(tokens)
+
+
+# The default query never changes, so its fields are only built once
+INCLUDE_FIELDS = build_query_fields(build_search_query())